@@ -4,6 +4,7 @@ import borrowed.spectral_norm as SN
 from collections import OrderedDict
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint_sequential
 import copy
 
 
@@ -548,8 +549,11 @@ class RRDBNet(nn.Module):
         act_type="leakyrelu",
         mode="CNA",
         upsample_mode="upconv",
+        checkpoint_segments=0,
     ):
         super(RRDBNet, self).__init__()
+        # recompute RRDB trunk activations on backward to save memory
+        self.checkpoint_segments = checkpoint_segments
         n_upscale = int(math.log(upscale, 2))
         if upscale == 3:
             n_upscale = 1
@@ -599,6 +603,15 @@ class RRDBNet(nn.Module):
         )
 
     def forward(self, x):
+        if self.checkpoint_segments and self.training and torch.is_grad_enabled():
+            x = self.model[0](x)
+            trunk = self.model[1].sub
+            x = x + checkpoint_sequential(
+                trunk, self.checkpoint_segments, x, use_reentrant=False
+            )
+            for module in self.model[2:]:
+                x = module(x)
+            return x
         x = self.model(x)
         return x
 
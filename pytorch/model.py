@@ -3,10 +3,14 @@ from collections import OrderedDict
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 from torch.optim import lr_scheduler
 
 from networks import *
 from borrowed.loss import GANLoss, GradientPenaltyLoss
+from utils import is_distributed
 
 logger = logging.getLogger("base")
 
@@ -15,9 +19,27 @@ class BaseModel:
     def __init__(self, opt):
         self.opt = opt
         self.device = torch.device("cuda" if opt["gpu_ids"] is not None else "cpu")
+        self.rank = 0
+        self.world_size = 1
+        if is_distributed():
+            # one process per gpu, launched by torchrun
+            self.rank = dist.get_rank()
+            self.world_size = dist.get_world_size()
+            self.device = torch.device("cuda:{}".format(torch.cuda.current_device()))
         self.is_train = opt["is_train"]
+        # shapes are fixed per config, let cuDNN autotune unless runs must repeat
+        torch.backends.cudnn.benchmark = not opt["reproducible"]
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        # NHWC lets cuDNN pick the Tensor Core convolution kernels
+        self.memory_format = torch.contiguous_format
+        if self.device.type == "cuda":
+            self.memory_format = torch.channels_last
         self.schedulers = []
         self.optimizers = []
+        self.scalers = []
+        self._last_lr = None
+        self._in_train_step = False
 
     def feed_data(self, data):
         pass
@@ -40,41 +62,70 @@ class BaseModel:
     def load(self):
         pass
 
+    def empty_cache(self):
+        # Returning blocks to the driver makes the caching allocator fall back
+        # to cudaMalloc/cudaFree on the next steps, so never do it per iteration.
+        self._no_empty_cache_in_train()
+        if self.device.type == "cuda":
+            with torch.cuda.device(self.device):
+                torch.cuda.empty_cache()
+
+    def _no_empty_cache_in_train(self):
+        if self.is_train and self._in_train_step:
+            raise RuntimeError("empty_cache must not be called during a training step.")
+
+    def define_adam(self, params, **kwargs):
+        # a single multi-tensor kernel updates all params, foreach before torch 2.0
+        if self.device.type == "cuda":
+            try:
+                return torch.optim.Adam(params, fused=True, **kwargs)
+            except TypeError:
+                return torch.optim.Adam(params, foreach=True, **kwargs)
+        return torch.optim.Adam(params, **kwargs)
+
     def update_learning_rate(self):
         for scheduler in self.schedulers:
             scheduler.step()
+        self._last_lr = self.schedulers[0].get_last_lr()[0]
 
     def get_current_learning_rate(self):
-        return self.schedulers[0].get_lr()[0]
+        if self._last_lr is None:
+            self._last_lr = self.schedulers[0].get_last_lr()[0]
+        return self._last_lr
 
     def get_network_description(self, network):
-        if isinstance(network, nn.DataParallel):
+        if isinstance(network, (nn.DataParallel, DistributedDataParallel)):
             network = network.module
         s = str(network)
         n = sum(map(lambda x: x.numel(), network.parameters()))
         return s, n
 
     def save_network(self, network, network_label, iter_step):
+        if self.rank != 0:
+            return
         save_filename = "{}_{}.pth".format(iter_step, network_label)
         save_path = os.path.join(self.opt["path"]["models"], save_filename)
-        if isinstance(network, nn.DataParallel):
+        if isinstance(network, (nn.DataParallel, DistributedDataParallel)):
             network = network.module
-        state_dict = network.state_dict()
-        for key, param in state_dict.items():
-            state_dict[key] = param.cpu()
+        state_dict = {k: v.detach().cpu() for k, v in network.state_dict().items()}
         torch.save(state_dict, save_path)
 
     def load_network(self, load_path, network, strict=True):
-        if isinstance(network, nn.DataParallel):
+        if isinstance(network, (nn.DataParallel, DistributedDataParallel)):
             network = network.module
-        network.load_state_dict(torch.load(load_path), strict=strict)
+        state_dict = torch.load(load_path, map_location=self.device)
+        network.load_state_dict(state_dict, strict=strict)
 
     def save_training_state(self, epoch, iter_step):
-        state = {"epoch": epoch, "iter": iter_step, "schedulers": [], "optimizers": []}
-        for s in self.schedulers:
-            state["schedulers"].append(s.state_dict())
-        for o in self.optimizers:
-            state["optimizers"].append(o.state_dict())
+        if self.rank != 0:
+            return
+        state = {
+            "epoch": epoch,
+            "iter": iter_step,
+            "schedulers": [s.state_dict() for s in self.schedulers],
+            "optimizers": [o.state_dict() for o in self.optimizers],
+            "scalers": [s.state_dict() for s in self.scalers],
+        }
         save_filename = "{}.state".format(iter_step)
         save_path = os.path.join(self.opt["path"]["training_state"], save_filename)
         torch.save(state, save_path)
@@ -88,10 +139,18 @@ class BaseModel:
         assert len(resume_schedulers) == len(
             self.schedulers
         ), "Wrong lengths of schedulers"
-        for i, o in enumerate(resume_optimizers):
-            self.optimizers[i].load_state_dict(o)
-        for i, s in enumerate(resume_schedulers):
-            self.schedulers[i].load_state_dict(s)
+        # Optimizer.load_state_dict already casts state to each param's device
+        for optimizer, o in zip(self.optimizers, resume_optimizers):
+            optimizer.load_state_dict(o)
+        for scheduler, s in zip(self.schedulers, resume_schedulers):
+            scheduler.load_state_dict(s)
+        # states saved before loss scaling was checkpointed have no scalers
+        resume_scalers = resume_state.get("scalers", [])
+        if len(resume_scalers) == len(self.scalers):
+            for scaler, s in zip(self.scalers, resume_scalers):
+                scaler.load_state_dict(s)
+        else:
+            logger.warning("Loss scaler states not restored, lengths differ.")
 
 
 class SRGANModel(BaseModel):
@@ -99,20 +158,45 @@ class SRGANModel(BaseModel):
         super(SRGANModel, self).__init__(opt)
         train_opt = opt["train"]
 
-        self.netG = networks.define_G(opt).to(self.device)
+        self.netG = networks.define_G(opt).to(
+            self.device, memory_format=self.memory_format
+        )
         if self.is_train:
-            self.netD = networks.define_D(opt).to(self.device)
+            self.netD = networks.define_D(opt).to(
+                self.device, memory_format=self.memory_format
+            )
             self.netG.train()
             self.netD.train()
         self.load()
 
+        if self.world_size > 1:
+            # wrap after loading so pretrained weights go into the bare modules,
+            # batch norm statistics are shared across all gpus
+            self.netG = nn.SyncBatchNorm.convert_sync_batchnorm(self.netG)
+            self.netG = DistributedDataParallel(
+                self.netG, device_ids=[self.device.index]
+            )
+            if self.is_train:
+                self.netD = nn.SyncBatchNorm.convert_sync_batchnorm(self.netD)
+                self.netD = DistributedDataParallel(
+                    self.netD, device_ids=[self.device.index]
+                )
+
+        # compile in place so state_dict keys and the wrappers above are kept
+        self.use_compile = bool(self.is_train and train_opt["torch_compile"])
+        if self.use_compile:
+            self.netG.compile(mode="max-autotune", dynamic=False)
+            # aot_autograd cannot double backward the wgan-gp penalty
+            if train_opt["gan_type"] != "wgan-gp":
+                self.netD.compile(mode="max-autotune", dynamic=False)
+
         if self.is_train:
             if train_opt["pixel_weight"] > 0:
                 l_pix_type = train_opt["pixel_criterion"]
                 if l_pix_type == "l1":
-                    self.cri_pix = nn.L1Loss().to(self.device)
+                    self.cri_pix = F.l1_loss
                 elif l_pix_type == "l2":
-                    self.cri_pix = nn.MSELoss().to(self.device)
+                    self.cri_pix = F.mse_loss
                 else:
                     raise NotImplementedError(
                         "Loss type [{:s}] not recognized.".format(l_pix_type)
@@ -125,9 +209,9 @@ class SRGANModel(BaseModel):
             if train_opt["feature_weight"] > 0:
                 l_fea_type = train_opt["feature_criterion"]
                 if l_fea_type == "l1":
-                    self.cri_fea = nn.L1Loss().to(self.device)
+                    self.cri_fea = F.l1_loss
                 elif l_fea_type == "l2":
-                    self.cri_fea = nn.MSELoss().to(self.device)
+                    self.cri_fea = F.mse_loss
                 else:
                     raise NotImplementedError(
                         "Loss type [{:s}] not recognized.".format(l_fea_type)
@@ -137,7 +221,14 @@ class SRGANModel(BaseModel):
                 logger.info("Remove feature loss.")
                 self.cri_fea = None
             if self.cri_fea:
-                self.netF = networks.define_F(opt, use_bn=False).to(self.device)
+                self.netF = networks.define_F(opt, use_bn=False).to(
+                    self.device, memory_format=self.memory_format
+                )
+                # netF is a fixed loss network, autograd only needs it for fake_H
+                self.netF.eval()
+                self.netF.requires_grad_(False)
+                if self.use_compile:
+                    self.netF.compile(mode="reduce-overhead", dynamic=False)
 
             self.cri_gan = GANLoss(train_opt["gan_type"], 1.0, 0.0).to(self.device)
             self.l_gan_w = train_opt["gan_weight"]
@@ -149,10 +240,37 @@ class SRGANModel(BaseModel):
             )
 
             if train_opt["gan_type"] == "wgan-gp":
-                self.random_pt = torch.Tensor(1, 1, 1, 1).to(self.device)
+                if self.world_size > 1:
+                    raise NotImplementedError(
+                        "wgan-gp is not supported with DistributedDataParallel, "
+                        "its gradient penalty needs autograd.grad through netD."
+                    )
                 self.cri_gp = GradientPenaltyLoss(device=self.device).to(self.device)
                 self.l_gp_w = train_opt["gp_weigth"]
 
+            # mixed precision: fp16 needs loss scaling, bf16 keeps fp32's exponent
+            amp_dtype = train_opt["amp_dtype"] if train_opt["amp_dtype"] else "fp16"
+            if amp_dtype == "fp16":
+                self.amp_dtype = torch.float16
+            elif amp_dtype == "bf16":
+                self.amp_dtype = torch.bfloat16
+            elif amp_dtype == "fp32":
+                self.amp_dtype = torch.float32
+            else:
+                raise NotImplementedError(
+                    "AMP dtype [{:s}] not recognized.".format(amp_dtype)
+                )
+            self.use_amp = (
+                self.device.type == "cuda" and self.amp_dtype != torch.float32
+            )
+            if self.use_amp and self.amp_dtype == torch.float16:
+                self.scaler_G = torch.amp.GradScaler("cuda")
+                self.scaler_D = torch.amp.GradScaler("cuda")
+                self.scalers += [self.scaler_G, self.scaler_D]
+            else:
+                self.scaler_G = None
+                self.scaler_D = None
+
             wd_G = train_opt["weight_decay_G"] if train_opt["weight_decay_G"] else 0
             optim_params = []
             for (k, v) in self.netG.named_parameters():
@@ -160,7 +278,7 @@ class SRGANModel(BaseModel):
                     optim_params.append(v)
                 else:
                     logger.warning("Params [{:s}] will not optimize.".format(k))
-            self.optimizer_G = torch.optim.Adam(
+            self.optimizer_G = self.define_adam(
                 optim_params,
                 lr=train_opt["lr_G"],
                 weight_decay=wd_G,
@@ -168,8 +286,8 @@ class SRGANModel(BaseModel):
             )
             self.optimizers.append(self.optimizer_G)
             wd_D = train_opt["weight_decay_D"] if train_opt["weight_decay_D"] else 0
-            self.optimizer_D = torch.optim.Adam(
-                self.netD.parameters(),
+            self.optimizer_D = self.define_adam(
+                list(self.netD.parameters()),
                 lr=train_opt["lr_D"],
                 weight_decay=wd_D,
                 betas=(train_opt["beta1_D"], 0.999),
@@ -190,82 +308,156 @@ class SRGANModel(BaseModel):
         self.print_network()
 
     def feed_data(self, data, need_HR=True):
-        self.var_L = data["LR"].to(self.device)
+        # overlaps with compute only for pinned batches (create_dataloader pins)
+        self.var_L = data["LR"].to(
+            self.device, memory_format=self.memory_format, non_blocking=True
+        )
         if need_HR:
-            self.var_H = data["HR"].to(self.device)
+            self.var_H = data["HR"].to(
+                self.device, memory_format=self.memory_format, non_blocking=True
+            )
 
             input_ref = data["ref"] if "ref" in data else data["HR"]
-            self.var_ref = input_ref.to(self.device)
+            self.var_ref = input_ref.to(
+                self.device, memory_format=self.memory_format, non_blocking=True
+            )
 
     def optimize_parameters(self, step):
-        self.optimizer_G.zero_grad()
-        self.fake_H = self.netG(self.var_L)
+        self._in_train_step = True
+        try:
+            self._optimize_parameters(step)
+        finally:
+            self._in_train_step = False
+
+    def _optimize_parameters(self, step):
+        do_g_step = step % self.D_update_ratio == 0 and step > self.D_init_iters
+        # D-only iterations use fake_H detached, no need to keep netG's graph
+        with torch.set_grad_enabled(do_g_step), self.autocast():
+            self.fake_H = self.netG(self.var_L)
 
         l_g_total = 0
-        if step % self.D_update_ratio == 0 and step > self.D_init_iters:
-            if self.cri_pix:
-                l_g_pix = self.l_pix_w * self.cri_pix(self.fake_H, self.var_H)
-                l_g_total += l_g_pix
-            if self.cri_fea:
-                real_fea = self.netF(self.var_H).detach()
-                fake_fea = self.netF(self.fake_H)
-                l_g_fea = self.l_fea_w * self.cri_fea(fake_fea, real_fea)
-                l_g_total += l_g_fea
-            pred_g_fake = self.netD(self.fake_H)
-            l_g_gan = self.l_gan_w * self.cri_gan(pred_g_fake, True)
-            l_g_total += l_g_gan
-
-            l_g_total.backward()
-            self.optimizer_G.step()
-
-        self.optimizer_D.zero_grad()
+        # netD is not touched by the G step, so its prediction on fake_H can be
+        # reused for the D loss. DDP does not support autograd.grad.
+        reuse_d_fake = do_g_step and self.world_size == 1
+        if do_g_step:
+            with self.autocast():
+                if self.cri_pix:
+                    l_g_pix = self.l_pix_w * self.cri_pix(self.fake_H, self.var_H)
+                    l_g_total += l_g_pix
+                if self.cri_fea:
+                    # one netF pass over real and fake, grads flow via fake_H only
+                    batch_size = self.var_H.size(0)
+                    fea = self.netF(torch.cat([self.var_H, self.fake_H], 0))
+                    real_fea = fea[:batch_size].detach()
+                    fake_fea = fea[batch_size:]
+                    l_g_fea = self.l_fea_w * self.cri_fea(fake_fea, real_fea)
+                    l_g_total += l_g_fea
+                if reuse_d_fake:
+                    # cut the graph at fake_H, only netD's part is kept for D
+                    d_in = self.fake_H.detach().requires_grad_()
+                else:
+                    d_in = self.fake_H
+                pred_g_fake = self.netD(d_in)
+                l_g_gan = self.l_gan_w * self.cri_gan(pred_g_fake, True)
+
+            if reuse_d_fake:
+                grad_fake = torch.autograd.grad(
+                    self.scale_loss(l_g_gan, self.scaler_G), d_in, retain_graph=True
+                )[0]
+                tensors, grad_tensors = [self.fake_H], [grad_fake]
+                if torch.is_tensor(l_g_total):
+                    tensors.append(self.scale_loss(l_g_total, self.scaler_G))
+                    grad_tensors.append(None)
+                torch.autograd.backward(tensors, grad_tensors)
+                self.step_optimizer(self.optimizer_G, self.scaler_G)
+            else:
+                l_g_total += l_g_gan
+                self.backward_step(l_g_total, self.optimizer_G, self.scaler_G)
+
+        # without reuse the G step also backpropagates into netD, drop those grads
+        self.optimizer_D.zero_grad(set_to_none=True)
         l_d_total = 0
-        pred_d_real = self.netD(self.var_ref)
-        l_d_real = self.cri_gan(pred_d_real, True)
-        pred_d_fake = self.netD(self.fake_H.detach())
-        l_d_fake = self.cri_gan(pred_d_fake, False)
+        with self.autocast():
+            pred_d_real = self.netD(self.var_ref)
+            l_d_real = self.cri_gan(pred_d_real, True)
+            if reuse_d_fake:
+                pred_d_fake = pred_g_fake
+            else:
+                pred_d_fake = self.netD(self.fake_H.detach())
+            l_d_fake = self.cri_gan(pred_d_fake, False)
 
-        l_d_total = l_d_real + l_d_fake
+            l_d_total = l_d_real + l_d_fake
 
         if self.opt["train"]["gan_type"] == "wgan-gp":
-            batch_size = self.var_ref.size(0)
-            if self.random_pt.size(0) != batch_size:
-                self.random_pt.resize_(batch_size, 1, 1, 1)
-            self.random_pt.uniform_()
-            interp = (
-                self.random_pt * self.fake_H.detach()
-                + (1 - self.random_pt) * self.var_ref
-            )
-            interp.requires_grad = True
-            interp_crit = self.netD(interp)
-            l_d_gp = self.l_gp_w * self.cri_gp(interp, interp_crit)
-            l_d_total += l_d_gp
+            # autograd.grad of the critic needs full precision
+            with self.autocast(enabled=False):
+                batch_size = self.var_ref.size(0)
+                alpha = torch.rand(
+                    batch_size, 1, 1, 1, device=self.device, dtype=self.var_ref.dtype
+                )
+                interp = (
+                    alpha * self.fake_H.detach().to(self.var_ref.dtype)
+                    + (1 - alpha) * self.var_ref
+                )
+                interp.requires_grad_(True)
+                interp_crit = self.netD(interp)
+                l_d_gp = self.l_gp_w * self.cri_gp(interp, interp_crit)
+                l_d_total += l_d_gp
 
-        l_d_total.backward()
-        self.optimizer_D.step()
+        self.backward_step(l_d_total, self.optimizer_D, self.scaler_D)
+        # drop netG's graph now rather than when the next step reassigns fake_H
+        self.fake_H = self.fake_H.detach()
 
-        if step % self.D_update_ratio == 0 and step > self.D_init_iters:
+        # keep the logs on device, get_current_log syncs them in one copy
+        if do_g_step:
             if self.cri_pix:
-                self.log_dict["l_g_pix"] = l_g_pix.item()
+                self.log_dict["l_g_pix"] = l_g_pix.detach()
             if self.cri_fea:
-                self.log_dict["l_g_fea"] = l_g_fea.item()
-            self.log_dict["l_g_gan"] = l_g_gan.item()
-        self.log_dict["l_d_real"] = l_d_real.item()
-        self.log_dict["l_d_fake"] = l_d_fake.item()
+                self.log_dict["l_g_fea"] = l_g_fea.detach()
+            self.log_dict["l_g_gan"] = l_g_gan.detach()
+        self.log_dict["l_d_real"] = l_d_real.detach()
+        self.log_dict["l_d_fake"] = l_d_fake.detach()
 
         if self.opt["train"]["gan_type"] == "wgan-gp":
-            self.log_dict["l_d_gp"] = l_d_gp.item()
+            self.log_dict["l_d_gp"] = l_d_gp.detach()
         self.log_dict["D_real"] = torch.mean(pred_d_real.detach())
         self.log_dict["D_fake"] = torch.mean(pred_d_fake.detach())
 
+    def autocast(self, enabled=True):
+        return torch.autocast(
+            device_type="cuda", dtype=self.amp_dtype, enabled=enabled and self.use_amp
+        )
+
+    def scale_loss(self, loss, scaler):
+        return scaler.scale(loss) if scaler is not None else loss
+
+    def step_optimizer(self, optimizer, scaler):
+        if scaler is not None:
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            optimizer.step()
+        # release grads right away instead of keeping them until the next step
+        optimizer.zero_grad(set_to_none=True)
+
+    def backward_step(self, loss, optimizer, scaler):
+        self.scale_loss(loss, scaler).backward()
+        self.step_optimizer(optimizer, scaler)
+
     def test(self):
-        self.netG.eval()
+        # validation images vary in size, so call the bare module's forward to
+        # skip both the compiled graph and the DP/DDP wrappers
+        netG = self.netG
+        if isinstance(netG, (nn.DataParallel, DistributedDataParallel)):
+            netG = netG.module
+        netG.eval()
         with torch.no_grad():
-            self.fake_H = self.netG(self.var_L)
-        self.netG.train()
+            self.fake_H = netG.forward(self.var_L)
+        netG.train()
 
     def get_current_log(self):
-        return self.log_dict
+        values = torch.stack([v.float() for v in self.log_dict.values()])
+        return OrderedDict(zip(self.log_dict.keys(), values.cpu().tolist()))
 
     def get_current_visuals(self, need_HR=True):
         out_dict = OrderedDict()
@@ -276,8 +468,10 @@ class SRGANModel(BaseModel):
         return out_dict
 
     def print_network(self):
+        if self.rank != 0:
+            return
         s, n = self.get_network_description(self.netG)
-        if isinstance(self.netG, nn.DataParallel):
+        if isinstance(self.netG, (nn.DataParallel, DistributedDataParallel)):
             net_struc_str = "{} - {}".format(
                 self.netG.__class__.__name__, self.netG.module.__class__.__name__
             )
@@ -289,7 +483,7 @@ class SRGANModel(BaseModel):
         logger.info(s)
         if self.is_train:
             s, n = self.get_network_description(self.netD)
-            if isinstance(self.netD, nn.DataParallel):
+            if isinstance(self.netD, (nn.DataParallel, DistributedDataParallel)):
                 net_struc_str = "{} - {}".format(
                     self.netD.__class__.__name__, self.netD.module.__class__.__name__
                 )
@@ -304,7 +498,7 @@ class SRGANModel(BaseModel):
 
             if self.cri_fea:
                 s, n = self.get_network_description(self.netF)
-                if isinstance(self.netF, nn.DataParallel):
+                if isinstance(self.netF, (nn.DataParallel, DistributedDataParallel)):
                     net_struc_str = "{} - {}".format(
                         self.netF.__class__.__name__,
                         self.netF.module.__class__.__name__,
@@ -4,6 +4,7 @@ import torch
 import torch.nn as nn
 from torch.nn import init
 from architecture import *
+from utils import is_distributed
 
 
 logger = logging.getLogger("base")
@@ -77,6 +78,27 @@ def define_G(opt):
     gpu_ids = opt["gpu_ids"]
     opt_net = opt["network_G"]
     which_model = opt_net["which_model_G"]
+    checkpoint_segments = 0
+    if opt["is_train"] and opt["train"]["grad_checkpoint"]:
+        checkpoint_segments = opt["train"]["grad_checkpoint"]
+        if which_model != "RRDB_net":
+            raise NotImplementedError(
+                "Gradient checkpointing is not supported for [{:s}]".format(
+                    which_model
+                )
+            )
+        # the checkpointed trunk holds nb RRDBs followed by LR_conv
+        trunk_len = opt_net["nb"] + 1
+        if (
+            not isinstance(checkpoint_segments, int)
+            or isinstance(checkpoint_segments, bool)
+            or not 1 <= checkpoint_segments <= trunk_len
+        ):
+            raise ValueError(
+                "grad_checkpoint must be an integer in [1, {:d}], got {}".format(
+                    trunk_len, checkpoint_segments
+                )
+            )
 
     if which_model == "sr_resnet":
         netG = SRResNet(
@@ -103,6 +125,7 @@ def define_G(opt):
             act_type="leakyrelu",
             mode=opt_net["mode"],
             upsample_mode="upconv",
+            checkpoint_segments=checkpoint_segments,
         )
     else:
         raise NotImplementedError(
@@ -113,7 +136,8 @@ def define_G(opt):
         init_weights(netG, init_type="kaiming", scale=0.1)
     if gpu_ids:
         assert torch.cuda.is_available()
-        netG = nn.DataParallel(netG)
+        if not is_distributed():
+            netG = nn.DataParallel(netG)
     return netG
 
 
@@ -156,7 +180,7 @@ def define_D(opt):
         )
 
     init_weights(netD, init_type="kaiming", scale=1)
-    if gpu_ids:
+    if gpu_ids and not is_distributed():
         netD = nn.DataParallel(netD)
     return netD
 
@@ -172,7 +196,7 @@ def define_F(opt, use_bn=False):
     netF = VGGFeatureExtractor(
         feature_layer=feature_layer, use_bn=use_bn, use_input_norm=True, device=device
     )
-    if gpu_ids:
+    if gpu_ids and not is_distributed():
         netF = nn.DataParallel(netF)
     netF.eval()
     return netF
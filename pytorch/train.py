@@ -9,21 +9,26 @@ from model import SRGANModel
 def main():
     opt = parse("train.json", is_train=True)
     opt = dict_to_nonedict(opt)
+    ddp_setup()
+    rank = get_rank()
 
     resume_state = None
-    mkdir_and_rename(opt["path"]["experiments_root"])
-    mkdirs(
-        (
-            path
-            for key, path in opt["path"].items()
-            if not key == "experiments_root"
-            and "pretrain_model" not in key
-            and "resume" not in key
+    if rank == 0:
+        mkdir_and_rename(opt["path"]["experiments_root"])
+        mkdirs(
+            (
+                path
+                for key, path in opt["path"].items()
+                if not key == "experiments_root"
+                and "pretrain_model" not in key
+                and "resume" not in key
+            )
         )
-    )
 
-    setup_logger(None, opt["path"]["log"], "train", level=logging.INFO, screen=True)
-    setup_logger("val", opt["path"]["log"], "val", level=logging.INFO)
+        setup_logger(
+            None, opt["path"]["log"], "train", level=logging.INFO, screen=True
+        )
+        setup_logger("val", opt["path"]["log"], "val", level=logging.INFO)
     logger = logging.getLogger("base")
 
     if resume_state:
@@ -39,15 +44,20 @@ def main():
     seed = opt["train"]["manual_seed"]
     if seed is None:
         seed = random.randint(1, 10000)
-    logger.info("Random seed: {}".format(seed))
+    # offset by rank so augmentation and noise differ across gpus
+    seed += rank
+    if rank == 0:
+        logger.info("Random seed: {}".format(seed))
+    else:
+        print("Random seed of rank {}: {}".format(rank, seed))
     set_random_seed(seed)
 
-    torch.backends.cudnn.benckmark = True
-
     for phase, dataset_opt in opt["datasets"].items():
         if phase == "train":
             train_set = LRHRDataset(dataset_opt)
-            train_size = int(math.ceil(len(train_set) / dataset_opt["batch_size"]))
+            train_loader = create_dataloader(train_set, dataset_opt)
+            # per-rank iterations, the DistributedSampler splits the set
+            train_size = len(train_loader)
             logger.info(
                 "Number of train images: {:,d}, iters: {:,d}".format(
                     len(train_set), train_size
@@ -60,7 +70,6 @@ def main():
                     total_epochs, total_iters
                 )
             )
-            train_loader = create_dataloader(train_set, dataset_opt)
         elif phase == "val":
             val_set = LRHRDataset(dataset_opt)
             val_loader = create_dataloader(val_set, dataset_opt)
@@ -87,6 +96,8 @@ def main():
         "Start training from epoch: {:d}, iter: {:d}".format(start_epoch, current_step)
     )
     for epoch in range(start_epoch, total_epochs):
+        if hasattr(train_loader.sampler, "set_epoch"):
+            train_loader.sampler.set_epoch(epoch)
         for _, train_data in enumerate(train_loader):
             current_step += 1
             if current_step > total_iters:
@@ -105,7 +116,7 @@ def main():
                     message += "{:s}: {:.4e} ".format(k, v)
                 logger.info(message)
 
-            if current_step % opt["train"]["val_freq"] == 0:
+            if rank == 0 and current_step % opt["train"]["val_freq"] == 0:
                 avg_psnr = 0.0
                 idx = 0
                 for val_data in val_loader:
@@ -159,6 +170,8 @@ def main():
     logger.info("Saving the final model.")
     model.save("latest")
     logger.info("End of training.")
+    if is_distributed():
+        torch.distributed.destroy_process_group()
 
 
 if __name__ == "__main__":
@@ -15,10 +15,18 @@ import logging
 def create_dataloader(dataset, dataset_opt):
     phase = dataset_opt["phase"]
     if phase == "train":
+        sampler = None
+        shuffle = dataset_opt["use_shuffle"]
+        if is_distributed():
+            sampler = torch.utils.data.distributed.DistributedSampler(
+                dataset, shuffle=shuffle
+            )
+            shuffle = False
         return torch.utils.data.DataLoader(
             dataset,
             batch_size=dataset_opt["batch_size"],
-            shuffle=dataset_opt["use_shuffle"],
+            shuffle=shuffle,
+            sampler=sampler,
             num_workers=dataset_opt["n_workers"],
             drop_last=True,
             pin_memory=True,
@@ -29,6 +37,25 @@ def create_dataloader(dataset, dataset_opt):
         )
 
 
+def ddp_setup():
+    # torchrun sets LOCAL_RANK, plain `python train.py` stays single process.
+    # BaseModel picks up rank and device from the initialized process group.
+    if "LOCAL_RANK" not in os.environ:
+        return
+    torch.cuda.set_device(int(os.environ["LOCAL_RANK"]))
+    torch.distributed.init_process_group("nccl")
+
+
+def is_distributed():
+    return torch.distributed.is_available() and torch.distributed.is_initialized()
+
+
+def get_rank():
+    if is_distributed():
+        return torch.distributed.get_rank()
+    return 0
+
+
 def get_timestamp():
     return datetime.now().strftime("%y%m%d-%H%M%S")
 